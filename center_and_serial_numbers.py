@@ -2,21 +2,36 @@ import sys
 import tracemalloc
 from argparse import ArgumentParser
 
+from memory_usage import write_memory_report
+
 
 def serial_numbers(file_in, file_out, set, center=50):
     serial = 1
 
-    for l in file_in:
-        row = l.strip().split('\t')
-        chrom = row[0]
-        original_start = int(row[1])
-        original_end = int(row[2])
-        midpoint = (original_start + original_end) // 2
-        start = midpoint - center
-        end = midpoint + center
-        interval = f'{chrom}:{start}-{end}|{set}_{serial}'
-        file_out.write(f'{chrom}\t{start}\t{end}\t{interval}\t0.0\t+\n')
-        serial += 1
+    # Read and write in blocks of about 1 MiB of input instead of one line
+    # at a time.
+    while True:
+        lines = file_in.readlines(1 << 20)
+        if not lines:
+            break
+
+        out = []
+        for l in lines:
+            # Only the first three fields are used, so the rest of the line
+            # is left unsplit. int() ignores the trailing newline on a
+            # three column line.
+            row = l.split('\t', 3)
+            chrom = row[0]
+            original_start = int(row[1])
+            original_end = int(row[2])
+            midpoint = (original_start + original_end) // 2
+            start = midpoint - center
+            end = midpoint + center
+            interval = f'{chrom}:{start}-{end}|{set}_{serial}'
+            out.append(f'{chrom}\t{start}\t{end}\t{interval}\t0.0\t+\n')
+            serial += 1
+
+        file_out.write(''.join(out))
 
 
 if __name__ == '__main__':
@@ -30,12 +45,13 @@ if __name__ == '__main__':
     )
     parser.add_argument('--set', default='default', required=False, type=str)
     parser.add_argument('--center', default=50, required=False, type=int)
+    parser.add_argument('--trace-memory', action='store_true')
     args = parser.parse_args()
 
-    tracemalloc.start()
+    if args.trace_memory:
+        tracemalloc.start()
     serial_numbers(sys.stdin, sys.stdout, args.set, args.center)
-    sys.stderr.write(f'# Max memory used: {tracemalloc.get_traced_memory()[1]} bytes\n')
-    tracemalloc.stop()
+    write_memory_report(sys.stderr)
 
     sys.stdin.close()
     sys.stderr.close()
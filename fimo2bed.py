@@ -1,16 +1,406 @@
+import io
 import sys
-import csv
 import tracemalloc
-from operator import attrgetter
+from array import array
 from argparse import ArgumentParser, BooleanOptionalAction
+from collections import deque
+from functools import partial
+from importlib.util import find_spec
+from itertools import islice
+from multiprocessing import Pool
 
-from interval import Interval
+from interval import chromosome_sort_key
+from memory_usage import write_memory_report
 
 
-def fimo_to_bed(file_in, file_out, log_out, sort, set_name, shift=False, center=0):
+# The fimo.tsv columns that are read, in the order parse_fimo_lines() takes
+# their positions.
+FIMO_COLUMNS = ("sequence_name", "score", "strand", "bin", "fold_change", "start", "stop")
+
+
+def find_fimo_columns(header):
+    """
+    Finds the position of each of FIMO_COLUMNS in a fimo.tsv header.
+
+    Parameters
+    ----------
+    header: list of str
+        The column names of the header row.
+
+    Returns
+    -------
+    tuple of int
+        The positions, in the order of FIMO_COLUMNS.
+    """
+    missing = [name for name in FIMO_COLUMNS if name not in header]
+    if missing:
+        raise ValueError(f"fimo input is missing the column(s): {', '.join(missing)}")
+    return tuple(map(header.index, FIMO_COLUMNS))
+
+
+def parse_fimo_lines(lines, columns, shift=False, center=0):
+    """
+    Parses a block of fimo.tsv lines into parallel columns, one entry per
+    data row, with shift and center already applied. Lines with a leading
+    "#" and blank lines are skipped.
+
+    Parameters
+    ----------
+    lines
+        A list of lines from the fimo.tsv, after the header.
+
+    columns
+        The positions of the sequence_name, score, strand, bin, fold_change,
+        start and stop columns, in that order.
+
+    shift
+        If True, shifts the fragment to the motif
+
+    center
+        If non-zero, shifts the fragment to its center +/- the width
+        specified by this parameter.
+
+    Returns
+    -------
+    tuple
+        The chromosomes, starts, ends, scores, strands, bins and fold changes
+        of the rows.
+    """
+    i_seq, i_score, i_strand, i_bin, i_fold_change, i_start, i_stop = columns
+    # Columns after the last one needed are left unsplit.
+    maxsplit = max(columns) + 1
+
+    chromosomes = []
+    starts = array("q")
+    ends = array("q")
+    scores = array("d")
+    strands = []
+    bins = []
+    fold_changes = []
+
+    for line in lines:
+        if line[0] == "#":
+            continue
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        fields = line.split("\t", maxsplit)
+
+        chromosome, _, locations = fields[i_seq].partition(":")
+        start, _, end = locations.partition("-")
+        start = int(start)
+
+        # fimo start and stop are relative to the start of the sequence, so a
+        # shifted fragment never needs the end of the sequence name.
+        if shift:
+            end = start + int(fields[i_stop]) - 1
+            start += int(fields[i_start])
+        else:
+            end = int(end)
+
+        if center != 0:
+            midpoint = (start + end) // 2
+            start = midpoint - center
+            end = midpoint + center
+
+        chromosomes.append(chromosome)
+        starts.append(start)
+        ends.append(end)
+        scores.append(float(fields[i_score]))
+        strands.append(fields[i_strand])
+        bins.append(fields[i_bin])
+        fold_changes.append(fields[i_fold_change])
+
+    return chromosomes, starts, ends, scores, strands, bins, fold_changes
+
+
+def reduce_fimo_lines(lines, columns, shift=False, center=0):
+    """
+    Parses lines like parse_fimo_lines() and dedups them within the block:
+    each location keeps only its highest scoring row, the first one on a
+    tie, at the position where the location first appears. Merging reduced
+    blocks in order with the same rule gives the same fragments and serial
+    numbers as deduplicating every row, so workers can take this part of
+    the dedup off the main process. No log can be written from it, since a
+    skip is logged against the best row seen so far in the whole input.
+
+    Parameters
+    ----------
+    lines
+        The lines of a block, as for parse_fimo_lines().
+
+    columns
+        The positions of the needed fields, as for parse_fimo_lines().
+
+    shift
+        If True, shifts the fragment to the motif
+
+    center
+        If non-zero, shifts the fragment to its center +/- the width
+        specified by this parameter.
+
+    Returns
+    -------
+    tuple
+        The kept rows as the columns parse_fimo_lines() returns, each row's
+        offset within the block and the number of rows in the block.
+    """
+    chromosomes, starts, ends, scores, strands, bins, fold_changes = parse_fimo_lines(lines, columns, shift, center)
+
+    kept = {}
+    offsets = array("q")
+    for row, location in enumerate(zip(chromosomes, starts, ends)):
+        i = kept.get(location)
+        if i is None:
+            kept[location] = len(offsets)
+            offsets.append(row)
+        elif scores[row] > scores[offsets[i]]:
+            offsets[i] = row
+
+    parsed = (
+        [chromosomes[row] for row in offsets],
+        array("q", [starts[row] for row in offsets]),
+        array("q", [ends[row] for row in offsets]),
+        array("d", [scores[row] for row in offsets]),
+        [strands[row] for row in offsets],
+        [bins[row] for row in offsets],
+        [fold_changes[row] for row in offsets],
+    )
+    return parsed, offsets, len(chromosomes)
+
+
+def read_fimo_blocks(file_in, shift=False, center=0, jobs=1, reduce=False):
+    """
+    Reads a fimo.tsv and yields it as blocks of parsed columns, as returned
+    by parse_fimo_lines(). Rows with a leading "#" and blank rows are
+    skipped, and the first remaining row is the header.
+
+    Rows are parsed in blocks, in worker processes when jobs > 1. The
+    parsed blocks are handed back in input order, so they are the same as a
+    single process run, and at most 2 * jobs blocks are in flight at once. With reduce, the blocks are deduplicated in the
+    workers and yielded as returned by reduce_fimo_lines().
+
+    Parameters
+    ----------
+    file_in
+        A file handle to the input stream for example, sys.stdin.
+
+    shift
+        If True, shifts the fragment to the motif
+
+    center
+        If non-zero, shifts the fragment to its center +/- the width
+        specified by this parameter.
+
+    jobs
+        The number of worker processes that parse the input.
+
+    reduce
+        If True, parses the blocks with reduce_fimo_lines().
+
+    Returns
+    -------
+    generator
+    """
+    lines = iter(file_in)
+    for line in lines:
+        if line[0] != "#" and line.strip():
+            header = line.rstrip("\r\n").split("\t")
+            break
+    else:
+        return
+
+    columns = find_fimo_columns(header)
+
+    parse = partial(reduce_fimo_lines if reduce else parse_fimo_lines, columns=columns, shift=shift, center=center)
+    blocks = iter(lambda: list(islice(lines, 65536)), [])
+
+    if jobs <= 1:
+        yield from map(parse, blocks)
+        return
+
+    # Pool.imap() would keep every finished block until it is taken, so a
+    # main process slower than the workers would pile them up. At most
+    # 2 * jobs blocks are in flight instead, and they are taken back in
+    # input order.
+    with Pool(jobs) as pool:
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.apply_async(parse, (block,)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def read_fimo_pyarrow(file_in, shift=False, center=0, block_size=1 << 24):
+    """
+    Reads a fimo.tsv with pyarrow's multithreaded CSV reader and yields it
+    as blocks of parsed columns, as returned by parse_fimo_lines(). As with
+    read_fimo_blocks(), rows with a leading "#" and blank rows are skipped,
+    and the first remaining row is the header.
+
+    pyarrow is an optional dependency, only imported when this reader is
+    used.
+
+    Parameters
+    ----------
+    file_in
+        A file handle to the input stream for example, sys.stdin. If it is a
+        text stream, its underlying binary buffer is read. A text stream
+        without one, such as io.StringIO, is read whole and encoded to
+        UTF-8 first, so it is not streamed.
+
+    shift
+        If True, shifts the fragment to the motif
+
+    center
+        If non-zero, shifts the fragment to its center +/- the width
+        specified by this parameter.
+
+    block_size
+        The number of bytes pyarrow reads and parses at a time.
+
+    Returns
+    -------
+    generator
+    """
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+    except ImportError as e:
+        raise ImportError("the pyarrow parser needs the pyarrow package installed") from e
+
+    def skip_comment(row):
+        # The comment lines at the end of a fimo.tsv have fewer columns
+        # than the header, so pyarrow reports them as invalid rows.
+        return "skip" if row.text.startswith("#") else "error"
+
+    # The motif start and stop are parsed to int64 and the score to float64
+    # by the reader, which rounds like float(), so no per-row conversion is
+    # left in Python. The other columns go to the output as they are.
+    column_types = dict.fromkeys(FIMO_COLUMNS, pyarrow.string())
+    column_types.update(score=pyarrow.float64(), start=pyarrow.int64(), stop=pyarrow.int64())
+
+    # The header is found and checked here, the same way read_fimo_blocks()
+    # does it, and pyarrow reads the rest of the stream after it.
+    if hasattr(file_in, "buffer"):
+        file_in = file_in.buffer
+    elif isinstance(file_in, io.TextIOBase):
+        file_in = io.BytesIO(file_in.read().encode())
+    for line in file_in:
+        if line[:1] != b"#" and line.strip():
+            header = line.decode().rstrip("\r\n").split("\t")
+            break
+    else:
+        return
+
+    find_fimo_columns(header)
+
+    reader = pyarrow.csv.open_csv(
+        file_in,
+        read_options=pyarrow.csv.ReadOptions(block_size=block_size, column_names=header),
+        parse_options=pyarrow.csv.ParseOptions(delimiter="\t", quote_char=False, invalid_row_handler=skip_comment),
+        convert_options=pyarrow.csv.ConvertOptions(include_columns=FIMO_COLUMNS, column_types=column_types),
+    )
+
+    compute = pyarrow.compute
+    for batch in reader:
+        # chromosome:start-end is split and the fragment moved for the
+        # whole batch at once.
+        sequence_parts = compute.split_pattern(batch.column("sequence_name"), ":", max_splits=1)
+        locations = compute.split_pattern(compute.list_element(sequence_parts, 1), "-", max_splits=1)
+        start = compute.cast(compute.list_element(locations, 0), pyarrow.int64())
+
+        if shift:
+            end = compute.subtract(compute.add(start, batch.column("stop")), 1)
+            start = compute.add(start, batch.column("start"))
+        else:
+            end = compute.cast(compute.list_element(locations, 1), pyarrow.int64())
+
+        if center != 0:
+            midpoint = compute.shift_right(compute.add(start, end), 1)
+            start = compute.subtract(midpoint, center)
+            end = compute.add(midpoint, center)
+
+        yield (
+            compute.list_element(sequence_parts, 0).to_pylist(),
+            array("q", start.to_pylist()),
+            array("q", end.to_pylist()),
+            array("d", batch.column("score").to_pylist()),
+            batch.column("strand").to_pylist(),
+            batch.column("bin").to_pylist(),
+            batch.column("fold_change").to_pylist(),
+        )
+
+
+def format_bed_rows(fragments, serials, rows, name_tail):
+    """
+    Formats fragments as rows of a bed file.
+
+    Parameters
+    ----------
+    fragments
+        The chromosomes, starts, ends, scores, strands, bins and fold changes
+        columns, as returned by parse_fimo_lines().
+
+    serials
+        The serial number of each fragment, indexed like the columns.
+
+    rows
+        The indices of the fragments to format, in output order.
+
+    name_tail
+        The "|<set name>_" text that goes between the sequence name and the
+        serial number in the name column.
+
+    Returns
+    -------
+    str
+        The formatted rows, each ending in a newline.
+    """
+    chromosomes, starts, ends, scores, strands, bins, fold_changes = fragments
+
+    # start and end appear twice on each row, so they are converted to
+    # strings once rather than formatted twice.
+    out = []
+    append = out.append
+    for row in rows:
+        chromosome = chromosomes[row]
+        start = str(starts[row])
+        end = str(ends[row])
+        append(
+            f"{chromosome}\t{start}\t{end}\tb{bins[row]}/{fold_changes[row]}/"
+            f"{chromosome}:{start}-{end}{name_tail}{serials[row]}\t{scores[row]}\t{strands[row]}\n"
+        )
+
+    return "".join(out)
+
+
+def fimo_to_bed(
+    file_in,
+    file_out,
+    log_out,
+    sort,
+    set_name,
+    shift=False,
+    center=0,
+    jobs=1,
+    dedup=True,
+    parser="stdlib",
+    sorted_input=False,
+):
     """
     When reading the source fimo.tsv, it filters out rows with a leading "#"
-    character.
+    character and blank rows. The first remaining row is the header, which is
+    used to find the column of each field needed on the output.
+
+    Fragments that land on the same sequence name are deduplicated: the
+    fragment with the highest score is kept, and a tie keeps the first one
+    read. Each decision is logged as an append, replace or skip action.
+    Without dedup and sort, rows are written as they are parsed and memory
+    use no longer grows with the input.
 
     Parameters
     ----------
@@ -21,7 +411,8 @@ def fimo_to_bed(file_in, file_out, log_out, sort, set_name, shift=False, center=
         A file handle to the output stream for example, sys.stdout.
 
     log_out
-        A file handle to the loggin stream for example, sys.stderr
+        A file handle to the loggin stream for example, sys.stderr. If None,
+        no log is written and the log lines are never formatted.
 
     sort
         True if the output should be sorted. If sorted, the output will have
@@ -38,53 +429,165 @@ def fimo_to_bed(file_in, file_out, log_out, sort, set_name, shift=False, center=
         If non-zero, shifts the fragment to its center +/- the width
         specified by this parameter.
 
+    jobs
+        The number of worker processes that parse the input. With the default
+        of 1, everything runs in this process.
+
+    dedup
+        If True, keeps only the highest scoring fragment for each sequence
+        name. If False, every fragment is written.
+
+    parser
+        "stdlib" parses the input with read_fimo_blocks(), "pyarrow" with
+        read_fimo_pyarrow(), which ignores jobs and uses pyarrow's own
+        threads. "auto" picks pyarrow when it is installed, unless file_in
+        is a text stream with no binary buffer, such as io.StringIO.
+
+    sorted_input
+        If True, the input must have the rows of each sequence name next to
+        each other, after shift and center are applied. Duplicates are then
+        found by comparing each row with the last kept one, with no lookup
+        table, and without sort the output is streamed block by block.
+
     Returns
     -------
     None
     """
-    log_out.write("action\tinterval\treason\n")
+    # Log lines are buffered and written once per block of input rows rather
+    # than with one write() per row.
+    log_buf = []
+    log = None
+    if log_out is not None:
+        log_out.write("action\tinterval\treason\n")
+        log = log_buf.append
 
-    unique_intervals = {}
+    # Each unique fragment is a row across these parallel columns rather than
+    # an Interval instance. row_by_location maps the location of a fragment to
+    # its row. The location packs a small per-chromosome id with the start
+    # and end into one int, which stands in for the chromosome:start-end
+    # sequence name; the name string itself is only formatted for the log
+    # and the output.
+    chromosomes = []
+    starts = array("q")
+    ends = array("q")
+    scores = array("d")
+    strands = []
+    bins = []
+    fold_changes = []
+    serials = array("q")
+    fragments = (chromosomes, starts, ends, scores, strands, bins, fold_changes)
+    row_by_location = {}
+    chromosome_ids = {}
 
-    reader = csv.DictReader(
-        filter(lambda row: not row[0].strip().startswith("#"), file_in), delimiter="\t"
-    )
+    # The set name part of the name column is the same on every row, so it
+    # is built once.
+    name_tail = f"|{set_name}_"
+
+    reduced = False
+    if parser == "auto":
+        # pyarrow only reads bytes, so a text stream with no binary buffer,
+        # such as io.StringIO, stays on the standard library parser.
+        binary = hasattr(file_in, "buffer") or not isinstance(file_in, io.TextIOBase)
+        parser = "pyarrow" if binary and find_spec("pyarrow") is not None else "stdlib"
+    if parser == "pyarrow":
+        parsed_blocks = read_fimo_pyarrow(file_in, shift=shift, center=center)
+    else:
+        # With several workers and no log to write, the workers also dedup
+        # their own blocks, which leaves fewer rows to send back and look up.
+        reduced = dedup and not sorted_input and jobs > 1 and log is None
+        parsed_blocks = read_fimo_blocks(file_in, shift=shift, center=center, jobs=jobs, reduce=reduced)
 
     serial = 1
-    for row_in in reader:
-        intrvl = Interval(
-            row_in["sequence_name"], row_in["score"], row_in["strand"], set_name, row_in["bin"], row_in["fold_change"], serial
-        )
-        serial += 1
+    for parsed in parsed_blocks:
+        if not dedup:
+            # Every row is kept, so there is nothing to look up. Unless
+            # the output is sorted, the block is written out right away.
+            n = len(parsed[0])
+            if log is not None:
+                log_buf.extend([f"append\t{chromosome}:{start}-{end}\tnew fragment\n" for chromosome, start, end in zip(*parsed[:3])])
+            if sort:
+                for column, values in zip(fragments, parsed):
+                    column.extend(values)
+                serials.extend(range(serial, serial + n))
+            else:
+                file_out.write(format_bed_rows(parsed, range(serial, serial + n), range(n), name_tail))
+            serial += n
+        else:
+            if reduced:
+                parsed, offsets, n = parsed
+            else:
+                n = len(parsed[0])
+                offsets = range(n)
+            for chromosome, start, end, score, strand, _bin, fold_change, offset in zip(*parsed, offsets):
+                if sorted_input:
+                    # Duplicates are adjacent, so the only row a new one can
+                    # match is the last kept row.
+                    row = len(serials) - 1
+                    if row < 0 or start != starts[row] or end != ends[row] or chromosome != chromosomes[row]:
+                        row = None
+                else:
+                    chromosome_id = chromosome_ids.get(chromosome)
+                    if chromosome_id is None:
+                        chromosome_id = chromosome_ids[chromosome] = len(chromosome_ids) << 64
+                    location = chromosome_id + (start << 32) + end
+                    row = row_by_location.get(location)
 
-        if shift:
-            start_shift = int(row_in["start"])
-            end_shift = int(row_in["stop"])
-            intrvl.shift(start_shift=start_shift, end_shift=end_shift)
+                if row is None:
+                    if log is not None:
+                        log(f"append\t{chromosome}:{start}-{end}\tnew fragment\n")
+                    if not sorted_input:
+                        row_by_location[location] = len(serials)
+                    chromosomes.append(chromosome)
+                    starts.append(start)
+                    ends.append(end)
+                    scores.append(score)
+                    strands.append(strand)
+                    bins.append(_bin)
+                    fold_changes.append(fold_change)
+                    serials.append(serial + offset)
+                elif score > scores[row]:
+                    if log is not None:
+                        log(f"replace\t{chromosome}:{start}-{end}\tscore {score} greater than existing {scores[row]}\n")
+                    scores[row] = score
+                    strands[row] = strand
+                    bins[row] = _bin
+                    fold_changes[row] = fold_change
+                    serials[row] = serial + offset
+                elif log is not None:
+                    relation = "less than" if score < scores[row] else "equal to"
+                    log(f"skip\t{chromosome}:{start}-{end}\tscore {score} {relation} existing {scores[row]}\n")
 
-        if center != 0:
-            intrvl.center(center)
+            serial += n
 
-        if intrvl in unique_intervals and unique_intervals[intrvl] > intrvl:
-            log_out.write(f"skip\t{intrvl.sequence_name}\tscore {intrvl.score} less than existing {unique_intervals[intrvl].score}\n")
-        elif intrvl in unique_intervals and unique_intervals[intrvl] < intrvl:
-            log_out.write(f"replace\t{intrvl.sequence_name}\tscore {intrvl.score} greater than existing {unique_intervals[intrvl].score}\n")
-            unique_intervals[intrvl] = intrvl
-        else:
-            log_out.write(f"append\t{intrvl.sequence_name}\tnew fragment\n")
-            unique_intervals[intrvl] = intrvl
+            # With sorted input every row but the last is final. The last one
+            # may still be replaced by a duplicate at the start of the next
+            # block.
+            if sorted_input and not sort and len(serials) > 1:
+                n = len(serials) - 1
+                file_out.write(format_bed_rows(fragments, serials, range(n), name_tail))
+                for column in (*fragments, serials):
+                    del column[:n]
+
+        if log is not None:
+            log_out.writelines(log_buf)
+            log_buf.clear()
 
     if sort:
-        final_intervals = sorted(unique_intervals.values(), key=attrgetter('chromosome_sort_key', 'start', 'end'))
-        sort_serial = 1
-        for sort_interval in final_intervals:
-            sort_interval.serial = sort_serial
-            sort_serial += 1
+        # Pack (chromosome_sort_key, start, end) into one int per row so the
+        # sort compares plain ints. The chromosome key is parsed once per
+        # distinct chromosome, and coordinates fit well within 32 bits.
+        chromosome_keys = {chromosome: chromosome_sort_key(chromosome) << 64 for chromosome in set(chromosomes)}
+        sort_keys = [chromosome_keys[chromosome] + (start << 32) + end for chromosome, start, end in zip(chromosomes, starts, ends)]
+        order = sorted(range(len(serials)), key=sort_keys.__getitem__)
+        for sort_serial, row in enumerate(order, 1):
+            serials[row] = sort_serial
     else:
-        final_intervals = unique_intervals.values()
+        order = range(len(serials))
 
-    for unique_intervals in final_intervals:
-        file_out.write(str(unique_intervals) + "\n")
+    # Rows are formatted and written in chunks to keep the number of write()
+    # calls low on large inputs.
+    for chunk_start in range(0, len(order), 65536):
+        file_out.write(format_bed_rows(fragments, serials, order[chunk_start:chunk_start + 65536], name_tail))
 
 
 if __name__ == "__main__":
@@ -100,20 +603,45 @@ if __name__ == "__main__":
     parser.add_argument("--shift", action=BooleanOptionalAction, default=False)
     parser.add_argument("--set", default="default", required=False, type=str)
     parser.add_argument("--sort", action=BooleanOptionalAction, default=False)
+    parser.add_argument(
+        "--dedup",
+        action=BooleanOptionalAction,
+        default=True,
+        help="Keep only the highest scoring fragment per sequence name. With --no-dedup and no --sort, rows are streamed straight to the output.",
+    )
+    parser.add_argument("--jobs", default=1, required=False, type=int)
+    parser.add_argument(
+        "--sorted-input",
+        default=False,
+        required=False,
+        action=BooleanOptionalAction,
+        help="The rows of each sequence name are adjacent in the input, so dedup compares each row with the last kept one instead of keeping a lookup table.",
+    )
+    parser.add_argument("--parser", default="stdlib", required=False, choices=["stdlib", "pyarrow", "auto"])
+    parser.add_argument("--quiet", action=BooleanOptionalAction, default=False)
+    parser.add_argument("--trace-memory", action=BooleanOptionalAction, default=False)
     args = parser.parse_args()
 
-    tracemalloc.start()
+    log_out = None if args.quiet else sys.stderr
+
+    # --quiet leaves STDERR empty, so the memory is not reported either.
+    if args.trace_memory and log_out is not None:
+        tracemalloc.start()
     fimo_to_bed(
         file_in=sys.stdin,
         file_out=sys.stdout,
-        log_out=sys.stderr,
+        log_out=log_out,
         sort=args.sort,
         set_name=args.set,
         shift=args.shift,
         center=args.center,
+        jobs=args.jobs,
+        dedup=args.dedup,
+        parser=args.parser,
+        sorted_input=args.sorted_input,
     )
-    sys.stderr.write(f'# Max memory used: {tracemalloc.get_traced_memory()[1]} bytes\n')
-    tracemalloc.stop()
+    if log_out is not None:
+        write_memory_report(log_out)
 
     sys.stdin.close()
     sys.stdout.close()
@@ -9,8 +9,19 @@ class Interval:
     a second fragment that points to the same location, the current fragment
     with should be retained of replaced with the new fragment according to
     their scores.
+
+    Equality and hashing both use the sequence name, so two fragments that
+    point to the same location are the same key in a dict or set. The score
+    comparisons are a separate ordering meant to be called explicitly; they
+    play no part in dict or set membership. != is the inverse of ==, which
+    Python derives from __eq__.
     """
 
+    __slots__ = (
+        "set_name", "serial", "score", "strand", "chromosome", "start", "end", "_bin", "fold_change",
+        "sequence_name", "_hash", "_sort_key"
+    )
+
     def __init__(self, fragment_string, score, strand, set_name, _bin, fold_change, serial):
         """
         Parameters
@@ -27,8 +38,8 @@ class Interval:
 
         set_name: str
             The set name to be appended to each fragment sequence name. The sequence
-            name itself is based on the fimo.tsv sequence name and is formatted by
-            the sequence name property below.
+            name itself is based on the fimo.tsv sequence name and is kept in the
+            sequence_name attribute by _update_sequence_name() below.
 
         _bin: int
             The bin into which this interval falls.
@@ -44,12 +55,21 @@ class Interval:
         self.serial = serial
         self.score = float(score)
         self.strand = strand
-        self.chromosome = fragment_string.split(":")[0]
-        locations = fragment_string.split(":")[1].split("-")
-        self.start = int(locations[0])
-        self.end = int(locations[1])
+        chromosome, _, locations = fragment_string.partition(":")
+        start, _, end = locations.partition("-")
+        self.chromosome = chromosome
+        self.start = int(start)
+        self.end = int(end)
         self._bin = _bin
         self.fold_change = fold_change
+        # The sequence name, in the chromosome:start-end format of the
+        # fimo.tsv, is used both for bed output and for hashing the fragment
+        # in a dictionary. It is built from the parsed start and end, so
+        # that, for example, chr1:0100-200 becomes chr1:100-200. It and its
+        # hash are kept current by shift() and center(), so neither is
+        # recomputed when read.
+        self._update_sequence_name()
+        self._sort_key = None
 
     def shift(self, start_shift=0, end_shift=0):
         """
@@ -66,6 +86,7 @@ class Interval:
 
         self.start += start_shift
         self.end = self.start + end_shift - start_shift - 1
+        self._update_sequence_name()
 
     def center(self, width):
         """
@@ -81,21 +102,15 @@ class Interval:
         midpoint = (self.start + self.end) // 2
         self.start = midpoint - width
         self.end = midpoint + width
+        self._update_sequence_name()
 
-    @property
-    def sequence_name(self):
+    def _update_sequence_name(self):
         """
-        Returns the sequence name to be used in bed file output. This is
-        is in the format of the fimo.tsv output. This is used both for bed
-        output and hashing the fragments in a dictionary (see __hash__
-        below).
-
-        Returns
-        -------
-        str
+        Rebuilds the sequence name and its hash after start or end move.
         """
-        
-        return f"{self.chromosome}:{self.start}-{self.end}"
+
+        self.sequence_name = f"{self.chromosome}:{self.start}-{self.end}"
+        self._hash = hash(self.sequence_name)
 
     @property
     def chromosome_sort_key(self):
@@ -114,17 +129,10 @@ class Interval:
             The chromosome number.
         """
 
-        trim_left = self.chromosome[3:]
-        trim_right = trim_left.split("_")[0]
-
-        if trim_right == 'X':
-            return 100
-        elif trim_right == 'Y':
-            return 101
-        elif trim_right == 'Un':
-            return 99
-        else:
-            return int(trim_right)
+        # The chromosome never changes, so parse it on first use only.
+        if self._sort_key is None:
+            self._sort_key = chromosome_sort_key(self.chromosome)
+        return self._sort_key
 
     def __hash__(self):
         """
@@ -137,7 +145,7 @@ class Interval:
         int
         """
 
-        return hash(self.sequence_name)
+        return self._hash
 
     def __gt__(self, other):
         """
@@ -204,30 +212,15 @@ class Interval:
         Parameters
         ----------
         other: Fragment
-            The other fragment to compare the score to.
+            The other fragment to compare the sequence name to.
 
         Returns
         -------
         bool
-            True if the self.score == other.score
+            True if the self.sequence_name == other.sequence_name
         """
 
-        return self.score != other.score
-
-    def __ne__(self, other):
-        """
-        Parameters
-        ----------
-        other: Fragment
-            The other fragment to compare the score to.
-
-        Returns
-        -------
-        bool
-            True if the self.score != other.score
-        """
-
-        return self.score != other.score
+        return isinstance(other, Interval) and self.sequence_name == other.sequence_name
 
     def __str__(self):
         """
@@ -238,4 +231,34 @@ class Interval:
         str
         """
 
-        return f"{self.chromosome}\t{self.start}\t{self.end}\tb{self._bin}/{self.fold_change}/{self.sequence_name}|{self.set_name}_{self.serial}\t{self.score}\t{self.strand}"
\ No newline at end of file
+        return f"{self.chromosome}\t{self.start}\t{self.end}\tb{self._bin}/{self.fold_change}/{self.sequence_name}|{self.set_name}_{self.serial}\t{self.score}\t{self.strand}"
+
+
+_NAMED_CHROMOSOME_SORT_KEYS = {'X': 100, 'Y': 101, 'Un': 99}
+
+
+def chromosome_sort_key(chromosome):
+    """
+    Extracts the integer value out of a chromosome string, parses it, and
+    returns it. This is the sort key behind Interval.chromosome_sort_key and
+    is also used directly when sorting fragments that are not stored as
+    Interval instances.
+
+    Parameters
+    ----------
+    chromosome: str
+        The chromosome, for example "chr17" or "chr17_GL000258v2_alt".
+
+    Returns
+    -------
+    int
+        The chromosome number. X, Y and Un sort as 100, 101 and 99.
+    """
+
+    trim_left = chromosome[3:]
+    trim_right = trim_left.split("_", 1)[0]
+
+    sort_key = _NAMED_CHROMOSOME_SORT_KEYS.get(trim_right)
+    if sort_key is None:
+        sort_key = int(trim_right)
+    return sort_key
@@ -0,0 +1,49 @@
+import sys
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # resource is Unix only.
+    resource = None
+
+
+def max_rss_kib():
+    """
+    Returns the peak resident set size of this process in KiB, or None where
+    the resource module is not available. Unlike tracemalloc, reading it
+    costs nothing during the run.
+
+    Returns
+    -------
+    int or None
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def write_memory_report(log_out):
+    """
+    Writes the memory use of the run, as comment lines, to the end of the log.
+    The peak traced memory is written, and tracing stopped, only if
+    tracemalloc was started. The peak resident set size is written wherever
+    it is available.
+
+    Parameters
+    ----------
+    log_out
+        A file handle to the logging stream for example, sys.stderr.
+
+    Returns
+    -------
+    None
+    """
+    if tracemalloc.is_tracing():
+        log_out.write(f"# Max memory used: {tracemalloc.get_traced_memory()[1]} bytes\n")
+        tracemalloc.stop()
+    max_rss = max_rss_kib()
+    if max_rss is not None:
+        log_out.write(f"# Max RSS: {max_rss} KiB\n")